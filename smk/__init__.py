@@ -1,6 +1,28 @@
-from smk.library import get_local_library, get_system_library
-from smk.build import BuildType, BuildConfig, register_target
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from smk.library import get_local_library, get_system_library
+    from smk.build import BuildConfig, register_target
+    from smk.build_type import BuildType
 
 __all__ = [
     "BuildConfig", "BuildType", "get_local_library", "get_system_library", "register_target"
 ]
+
+# Submodules pull in rich, so they are imported on first attribute access.
+# This keeps `smk --help` from paying for them.
+_EXPORTS = {
+    "BuildConfig": "smk.build",
+    "BuildType": "smk.build_type",
+    "get_local_library": "smk.library",
+    "get_system_library": "smk.library",
+    "register_target": "smk.build",
+}
+
+
+def __getattr__(name: str):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+    return getattr(importlib.import_module(module), name)
@@ -1,15 +1,23 @@
-from typing import Annotated
+from typing import TYPE_CHECKING, Annotated
 import typer
 import pathlib
 import sys
-from rich import print
-import importlib.util
 
-from smk.build import BuildConfig, BuildError, BuildType, pull_target
+from smk.build_type import BuildType
+
+if TYPE_CHECKING:
+    from smk.build import BuildConfig
 
 project_root = pathlib.Path.cwd()
 
 def load_build():
+    # build.py registers its target on import, so only execute it once
+    if "_user_build" in sys.modules:
+        return sys.modules["_user_build"]
+
+    import importlib.util
+    from smk.build import BuildError
+
     build_path    = project_root / "build.py"
     if not build_path.exists():
         raise BuildError("No build.py in this project")
@@ -18,18 +26,27 @@ def load_build():
         raise BuildError("build.py can't be loaded")
     mod  = importlib.util.module_from_spec(spec)
 
-    sys.modules[spec.name] = mod
     loader = spec.loader
     if not loader:
         raise BuildError("build.py can't be executed")
-    loader.exec_module(mod)
+    sys.modules[spec.name] = mod
+    try:
+        loader.exec_module(mod)
+    except BaseException:
+        # Don't cache a half-executed build.py, same as importlib does
+        del sys.modules[spec.name]
+        raise
+    return mod
 
     
-def import_user_target() -> BuildConfig:
+def import_user_target() -> "BuildConfig":
+    from rich import print
+    from smk.build import pull_target
+
     load_build()
     try:
-        return next(pull_target())
-    except:
+        return pull_target()
+    except LookupError:
         print(f"[red bold]No targets found[/]")
         sys.exit(1)
 
@@ -1,20 +1,18 @@
-from collections.abc import Iterator
-import concurrent.futures
+from collections import Counter
 from dataclasses import dataclass, field
-from enum import StrEnum, auto
 import hashlib
 import shutil
 import subprocess
 import os
 import json
-import sys
 from pathlib import Path
-from typing_extensions import override
+from typing import Any
 from rich.table import Table
 from rich.console import Console
 from rich.panel import Panel
 
-from smk.library import Library
+from smk.build_type import BuildType
+from smk.library import Library, clear_system_library_cache
 
 
 # TODO:
@@ -31,11 +29,6 @@ from smk.library import Library
 console = Console()
 
 
-class BuildType(StrEnum):
-    Debug = auto()
-    Release = auto()
-
-
 class CompilationError(Exception):
     pass
 
@@ -44,31 +37,141 @@ class BuildError(Exception):
     pass
 
 
+CdbEntry = dict[str, str|list[str]]
+
+
+@dataclass(frozen=True)
+class CompileCommand:
+    """Everything `compile_file()` derives from a source and the active flags."""
+    obj_path: str
+    dep_path: str
+    cmd: list[str]
+    cdb_entry: CdbEntry
+    cmd_hash: str
+
+
 @dataclass
-class CompilationResult:
-    obj_path: Path
-    cdb_entry: dict[str, str|list[str]]
-    success: bool
+class CompileResults:
+    """Outputs of `BuildConfig.compile()`, in sources order."""
+    obj_paths: list[str] = field(default_factory=list)
+    cdb_entries: list[CdbEntry] = field(default_factory=list)
 
     
-__TARGET_REGISTRY: list["BuildConfig"] = []
+__TARGET_REGISTRY: dict[str, "BuildConfig"] = {}
+
+
+# Options whose value may be passed as a separate argument
+_PAIRED_CFLAGS = frozenset({
+    "-I", "-isystem", "-iquote", "-idirafter",
+    "-D", "-U", "-include", "-imacros", "-include-pch",
+})
+# Only include directories are deduplicated: repeating one changes nothing,
+# while e.g. macros depend on their order relative to each other.
+_INCLUDE_DIR_CFLAGS = ("-I", "-isystem", "-iquote", "-idirafter")
+
+
+def _cflag_units(flags: list[str]) -> list[tuple[str, ...]]:
+    """Group options with their separate value, if any."""
+    units: list[tuple[str, ...]] = []
+    it = iter(flags)
+    for flag in it:
+        value = next(it, None) if flag in _PAIRED_CFLAGS else None
+        units.append((flag,) if value is None else (flag, value))
+    return units
+
+
+def _include_dir_key(unit: tuple[str, ...]) -> tuple[str, str] | None:
+    """`("-I", "x")` and `("-Ix",)` give the same key, other flags give None."""
+    flag = unit[0]
+    for option in _INCLUDE_DIR_CFLAGS:
+        if flag == option and len(unit) == 2:
+            return option, unit[1]
+        if flag.startswith(option) and len(flag) > len(option) and len(unit) == 1:
+            return option, flag[len(option):]
+    return None
+
+
+def _merge_cflags(flags: list[str], new: list[str]) -> list[str]:
+    """
+    Concatenate two flag lists, dropping repeated include directories.
+    Anything else is kept as is, since its order may matter.
+    """
+    seen: set[tuple[str, str]] = set()
+    merged: list[str] = []
+    for unit in _cflag_units([*flags, *new]):
+        key = _include_dir_key(unit)
+        if key is not None:
+            if key in seen:
+                continue
+            seen.add(key)
+        merged.extend(unit)
+    return merged
+
+
+def _lib_units(flags: list[str]) -> list[tuple[str, ...]]:
+    """Group `-L`/`-l` with their separate value, if any."""
+    units: list[tuple[str, ...]] = []
+    it = iter(flags)
+    for flag in it:
+        value = next(it, None) if flag in ("-L", "-l") else None
+        units.append((flag,) if value is None else (flag, value))
+    return units
+
+
+def _merge_libs(libs: list[str], new: list[str]) -> list[str]:
+    """
+    Concatenate linker flags of already linked libraries and a new one.
+    `-L` directories keep their first occurrence, preserving search order.
+    A `-l` library named in both lists keeps only its occurrence in `new`,
+    so a shared dependency still comes after every static library that
+    needs it. Libraries repeated within `libs` (deliberate cycles) are
+    left alone.
+    """
+    old_units = _lib_units(libs)
+    new_units = _lib_units(new)
+    old_counts = Counter("".join(u) for u in old_units)
+    new_keys = {"".join(u) for u in new_units}
+
+    seen_dirs: set[str] = set()
+    merged: list[str] = []
+    for i, unit in enumerate([*old_units, *new_units]):
+        key = "".join(unit)
+        if key.startswith("-L"):
+            if key in seen_dirs:
+                continue
+            seen_dirs.add(key)
+        elif (
+            i < len(old_units) and key.startswith("-l")
+            and key in new_keys and old_counts[key] == 1
+        ):
+            continue # comes later, with the new library
+        merged.extend(unit)
+    return merged
+
+
+# Extra cflags per build type, appended after the user's ones
+_BUILD_TYPE_CFLAGS: dict[BuildType, tuple[str, ...]] = {
+    BuildType.Debug: ("-O0", "-g", "-D", "DEBUG", "-Wall", "-Wextra"),
+    BuildType.Release: ("-O3", "-D", "NDEBUG"),
+}
 
 
 def register_target(target: "BuildConfig"):
+    if __TARGET_REGISTRY.get(target.app_name) is target:
+        return
     if len(__TARGET_REGISTRY) > 0:
         console.print("[red]Multiple targets are not supported[/]")
         return
-    if target not in __TARGET_REGISTRY:
-        __TARGET_REGISTRY.append(target)
-        console.print(f"[yellow]Target {target.app_name} registered[/]")
-    else:
-        console.print("[red]One target can only be registered once[/]")
-        sys.exit(1)
+    __TARGET_REGISTRY[target.app_name] = target
+    console.print(f"[yellow]Target {target.app_name} registered[/]")
 
 
-def pull_target() -> Iterator["BuildConfig"]:
-    while len(__TARGET_REGISTRY) > 0:
-        yield __TARGET_REGISTRY.pop()
+def pull_target() -> "BuildConfig":
+    """Return the registered target. Raises `LookupError` if there is none."""
+    # Targets stay registered: build.py is loaded only once per process.
+    if not __TARGET_REGISTRY:
+        raise LookupError("No targets registered")
+    return next(reversed(__TARGET_REGISTRY.values()))
 
 
 
@@ -86,15 +189,22 @@ class BuildConfig:
     build_type: BuildType = BuildType.Debug
     
     _verbose: bool = False
+    _cache: dict[str, dict[str, Any]] = field(default_factory=dict, init=False, repr=False)
+    _stat_cache: dict[str, float] = field(default_factory=dict, init=False, repr=False)
+    _libraries: list[Library] = field(default_factory=list, init=False, repr=False)
+    _compiler_path: str = field(default="", init=False, repr=False)
+    _active_cflags: tuple[str, ...] | None = field(default=None, init=False, repr=False)
+    _build_root: Path = field(default=Path("build"), init=False, repr=False)
+    _cmd_cache: dict[tuple[str, str], CompileCommand] = field(
+        default_factory=dict, init=False, repr=False,
+    )
+    _cmd_cache_key: tuple[str, str, tuple[str, ...]] = field(
+        default=("", "", ()), init=False, repr=False,
+    )
 
 
-    @override
-    def __eq__(self, value: object, /) -> bool:
-        if isinstance(value, BuildConfig):
-            return self.app_name == value.app_name
-        return False
-
     def __post_init__(self):
+        self._build_root = self._build_dir
         console.print("Build initialized")
         table = Table(title="Summary", show_header=False)
         table.add_column("Name")
@@ -107,124 +217,261 @@ class BuildConfig:
         
 
     def add_import(self, import_path: str) -> None:
-        self.cflags.insert(0, import_path)
-        self.cflags.insert(0, "-I")
+        self.cflags = _merge_cflags(["-I", import_path], self.cflags)
 
     def link_library(self, library: Library) -> None:
-        self.cflags.extend(library.cflags)
-        self.libs.extend(library.libs)
+        if library in self._libraries:
+            return
+        self._libraries.append(library)
+        self.cflags = _merge_cflags(self.cflags, library.cflags)
+        self.libs = _merge_libs(self.libs, library.libs)
 
     def parse_dependencies(self, content: str) -> list[str]:
-        lines = content.replace('\\\n', '').split('\n')
-        for line in lines:
-            if ':' in line:
-                # Everything after the first colon is dependencies
-                _, deps_part = line.split(':', 1)
-                return deps_part.split()
-        return []
-
-    def __need_recompile(self, obj_path: Path, dep_path: Path) -> bool:
-        # Means, not first time compiling
-        if obj_path.exists() and dep_path.exists():
-            obj_mtime = obj_path.stat().st_mtime
+        # Everything after the first colon is dependencies
+        _, sep, deps_part = content.partition(':')
+        if not sep:
+            return []
+        # The rule ends at the first newline that isn't escaped
+        rule, _, _ = deps_part.replace('\\\n', ' ').partition('\n')
+        return rule.split()
+
+    def _cache_path(self) -> Path:
+        return self._build_dir / ".cache.json"
+
+    def _load_cache(self) -> None:
+        try:
+            with open(self._cache_path()) as f:
+                self._cache = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._cache = {}
 
-            with open(dep_path, 'r') as f:
-                dependencies = self.parse_dependencies(f.read())
-            for dep in dependencies:
-                pd = Path(dep)
-                if not pd.exists():
-                    return True
-                if pd.stat().st_mtime > obj_mtime:
-                    return True
-            return False
+    def _save_cache(self) -> None:
+        self._build_dir.mkdir(parents=True, exist_ok=True)
+        with open(self._cache_path(), "w") as f:
+            json.dump(self._cache, f)
 
-        return True
+    def _calc_cmd_hash(self, cmd: list[str]) -> str:
+        return hashlib.blake2b("\0".join(cmd).encode(), digest_size=16).hexdigest()
 
-    def compile_file(self, source: str) -> CompilationResult:
-        ps = Path(source)
-        obj_path = self._build_dir / ps.with_suffix(".o")
-        dep_path = self._build_dir / ps.with_suffix(".d")
+    def _mtime(self, path: str) -> float:
+        """
+        Return mtime of `path`, stat'ing it only once per build.
+        Headers are usually shared between sources, and objects checked
+        during compilation are checked again before linking.
+        """
+        mtime = self._stat_cache.get(path)
+        if mtime is None:
+            mtime = os.stat(path).st_mtime
+            self._stat_cache[path] = mtime
+        return mtime
+
+    def _load_deps(
+            self, dep_path: str, entry: dict[str, Any] | None = None,
+    ) -> tuple[list[str], float]:
+        """
+        Return sorted dependencies listed in `dep_path`, and its mtime.
+        The file is only parsed if it changed since `entry` was recorded.
+        """
+        dep_mtime = os.stat(dep_path).st_mtime
+        if entry is not None and entry.get("dep_mtime") == dep_mtime:
+            return entry["deps"], dep_mtime
+        with open(dep_path, 'r') as f:
+            return sorted(set(self.parse_dependencies(f.read()))), dep_mtime
 
-        obj_path.parent.mkdir(parents=True, exist_ok=True)
+    def _calc_deps_hash(self, deps: list[str]) -> str | None:
+        """
+        Fingerprint `deps` by path and mtime.
+        Returns None if any of them is missing.
+        """
+        h = hashlib.blake2b(digest_size=16)
+        for dep in deps:
+            try:
+                mtime = self._mtime(dep)
+            except FileNotFoundError:
+                return None
+            h.update(f"{dep}\0{mtime}\0".encode())
+        return h.hexdigest()
+
+    def __need_recompile(self, obj_path: str, dep_path: str, cmd_hash: str) -> bool:
+        # Stat through the cache, so the link step can reuse the mtime
+        try:
+            _ = self._mtime(obj_path)
+        except FileNotFoundError:
+            return True
+        # Means, not first time compiling
+        entry = self._cache.get(obj_path)
+        if entry is None or entry["cmd_hash"] != cmd_hash:
+            return True
+        try:
+            deps, _ = self._load_deps(dep_path, entry)
+        except FileNotFoundError:
+            return True
+        return self._calc_deps_hash(deps) != entry["deps_hash"]
+
+    def _compile_cflags(self) -> tuple[str, ...]:
+        """Flags set up by `build()`, or plain `cflags` when called outside of it."""
+        if self._active_cflags is None:
+            return (*self.cflags,)
+        return self._active_cflags
+
+    def _compile_command(self, source: str, build_root: str) -> CompileCommand:
+        # Plain string ops, no Path objects. The result is cached per source.
+        # Normalized first, so "./src/a.c" and "src/a.c/" map to the same
+        # object. Like Path.with_suffix, only the last suffix is replaced.
+        normalized = os.path.normpath(source)
+        stem, dot, ext = normalized.rpartition(".")
+        if not dot or "/" in ext or not os.path.basename(stem):
+            stem = normalized
+        base = os.path.join(build_root, stem)
+        obj_path = base + ".o"
+        dep_path = base + ".d"
 
         cmd: list[str] = [
             self.compiler,
-            *self.cflags,
-            "-MMD", "-MF", str(dep_path), # dependencies for correct skips
+            *self._compile_cflags(),
+            "-MMD", "-MF", dep_path, # dependencies for correct skips
             "-c", source,
-            "-o", str(obj_path),
+            "-o", obj_path,
         ]
 
-        cdb_entry = {
+        cdb_entry: CdbEntry = {
             "directory": self.root_dir,
             "arguments": cmd,
             "file": source,
         }
-
-        if not self.__need_recompile(obj_path, dep_path):
+        return CompileCommand(obj_path, dep_path, cmd, cdb_entry, self._calc_cmd_hash(cmd))
+
+    def compile_file(
+            self, source: str, build_root: str | None = None,
+    ) -> tuple[str, CdbEntry, bool]:
+        """Compile one source. Returns object path, CDB entry and success."""
+        build_root = build_root or str(self._build_dir)
+        key = (source, build_root)
+        command = self._cmd_cache.get(key)
+        if command is None:
+            command = self._compile_command(source, build_root)
+            self._cmd_cache[key] = command
+        obj_path, dep_path = command.obj_path, command.dep_path
+        cmd, cdb_entry, cmd_hash = command.cmd, command.cdb_entry, command.cmd_hash
+
+        os.makedirs(os.path.dirname(obj_path), exist_ok=True)
+
+        if not self.__need_recompile(obj_path, dep_path, cmd_hash):
             console.print(f"[yellow]{obj_path} is up to date. Skipping...[/]")
-            return CompilationResult(obj_path, cdb_entry, True)
+            return obj_path, cdb_entry, True
         try:
             console.print(f"[yellow]Compiling {source}...[/]")
             if self._verbose:
                 console.print(f"Compile command: {' '.join(cmd)}")
             _ = subprocess.run(
-                cmd, check=True, capture_output=True, text=True,
+                cmd,
+                executable=self._compiler_path or None,
+                check=True,
+                # diagnostics go to stderr, stdout is not needed
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                text=True,
+                # together with an absolute executable, lets CPython use posix_spawn
+                close_fds=False,
             )
-            return CompilationResult(obj_path, cdb_entry, True)
+            deps, dep_mtime = self._load_deps(dep_path)
+            deps_hash = self._calc_deps_hash(deps)
+            if deps_hash is not None:
+                self._cache[obj_path] = {
+                    "cmd_hash": cmd_hash,
+                    "deps_hash": deps_hash,
+                    "deps": deps,
+                    "dep_mtime": dep_mtime,
+                }
+            else:
+                _ = self._cache.pop(obj_path, None)
+            # Record the fresh object, so linking sees it without another pass
+            self._stat_cache[obj_path] = os.stat(obj_path).st_mtime
+            return obj_path, cdb_entry, True
         except subprocess.CalledProcessError as e:
+            _ = self._cache.pop(obj_path, None)
             console.print(f"[red bold]Error compiling {source}:[/]")
-            console.print(Panel(e.stdout + e.stderr, border_style="red"))
-            return CompilationResult(obj_path, cdb_entry, False)
-
-    def compile(self) -> list[CompilationResult]:
-        """Compile sources."""
-        console.print("[yellow bold]Compilation started[/]")
-        res: list[CompilationResult] = []
+            console.print(Panel(e.stderr, border_style="red"))
+            return obj_path, cdb_entry, False
 
-        # up to min(32, os.cpu_count() + 4) workers
-        # NOTE: ‘self’ is copied into each process, consider pure function
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            f2s = {
-                executor.submit(self.compile_file, s): s for s in self.sources
-            }
-            for future in concurrent.futures.as_completed(f2s):
-                f_res = future.result()
-                res.append(f_res)
+    def compile(self, mtimes: dict[str, float] | None = None) -> CompileResults:
+        """
+        Compile sources.
+        `mtimes` is filled with mtimes of dependencies and objects seen,
+        pass the same dict to `link()` to reuse them.
+        """
+        import concurrent.futures
 
-                if not f_res.success:
-                    raise CompilationError("Build failed.")
+        console.print("[yellow bold]Compilation started[/]")
+        by_index: dict[int, tuple[str, CdbEntry]] = {}
+        self._load_cache()
+        self._stat_cache = mtimes if mtimes is not None else {}
+        self._compiler_path = shutil.which(self.compiler) or self.compiler
+        # Commands are reused across builds until anything they embed changes
+        cmd_cache_key = (self.compiler, self.root_dir, self._compile_cflags())
+        if cmd_cache_key != self._cmd_cache_key:
+            self._cmd_cache.clear()
+            self._cmd_cache_key = cmd_cache_key
+
+        build_root = str(self._build_dir)
+
+        # Workers mostly wait on the compiler, so threads are enough.
+        # They share `self` (and its cache); rich's Console is thread-safe.
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(32, os.cpu_count() or 4),
+            ) as executor:
+                f2i = {
+                    executor.submit(self.compile_file, s, build_root): i
+                    for i, s in enumerate(self.sources)
+                }
+                for future in concurrent.futures.as_completed(f2i):
+                    obj_path, cdb_entry, success = future.result()
+                    by_index[f2i[future]] = (obj_path, cdb_entry)
+
+                    if not success:
+                        raise CompilationError("Build failed.")
+        finally:
+            self._save_cache()
 
         console.print("[green]Compilation finished successfully[/]")
+        # Keep sources order, so the link command is stable between builds
+        res = CompileResults()
+        for i in range(len(self.sources)):
+            obj_path, cdb_entry = by_index[i]
+            res.obj_paths.append(obj_path)
+            res.cdb_entries.append(cdb_entry)
         return res
 
     @property
     def app_path(self) -> str:
         return os.path.join(self._build_dir, self.app_name)
 
-    def _link_hash_path(self) -> Path:
-        return self._build_dir / f".{self.app_name}.linkhash"
+    def _link_cmd_path(self) -> Path:
+        return self._build_dir / f".{self.app_name}.linkcmd"
+
+    def _encode_link_cmd(self, cmd: list[str]) -> bytes:
+        return b"\0".join(c.encode() for c in cmd)
 
-    def _calc_link_hash(self, cmd: list[str]) -> str:
-        sorted_cmd = sorted(cmd)
-        return hashlib.sha256(" ".join(sorted_cmd).encode()).hexdigest()
-    
     def __need_relink(self, obj_paths: list[str], link_cmd: list[str]) -> bool:
-        if not os.path.exists(self.app_path):
+        try:
+            app_mtime = os.path.getmtime(self.app_path)
+        except FileNotFoundError:
             return True
 
-        cmd_hash = self._calc_link_hash(link_cmd)
+        # Link commands are short, comparing them directly is cheaper than hashing
         try:
-            if open(self._link_hash_path()).read().strip() != cmd_hash:
+            if self._link_cmd_path().read_bytes() != self._encode_link_cmd(link_cmd):
                 return True
         except FileNotFoundError:
             return True
-        
-        app_mtime = os.path.getmtime(self.app_path)
-        return any(os.path.getmtime(obj) > app_mtime for obj in obj_paths)
+
+        # Objects seen by compile() are looked up, not stat'ed again
+        return any(self._mtime(obj) > app_mtime for obj in obj_paths)
     
 
-    def link(self, obj_paths: list[str]):
+    def link(self, obj_paths: list[str], mtimes: dict[str, float] | None = None):
+        self._stat_cache = mtimes if mtimes is not None else {}
         console.print("[yellow bold]Linking...[/]")
         link_cmd = [
             self.compiler,
@@ -237,7 +484,7 @@ class BuildConfig:
             if self._verbose:
                 console.print(f"Linking command: {' '.join(link_cmd)}")
             _ = subprocess.run(link_cmd, check=True)
-            _ = self._link_hash_path().write_text(self._calc_link_hash(link_cmd))
+            _ = self._link_cmd_path().write_bytes(self._encode_link_cmd(link_cmd))
             console.print("[green]Linking finished successfully[/]")
         else:
             console.print("[yellow]No changes detected. Skipping link step...[/]")
@@ -256,26 +503,37 @@ class BuildConfig:
         """
         self._verbose = verbose
         self.build_type = build_type
-        self._build_dir = self._build_dir / Path(self.build_type.value)
-        match self.build_type:
-            case BuildType.Debug:
-                self.cflags = self.cflags + ["-O0", "-g", "-D", "DEBUG", "-Wall", "-Wextra"]
-            case BuildType.Release:
-                self.cflags = self.cflags + ["-O3", "-D", "NDEBUG"]
+        # Derived from the originals, so repeated builds don't stack them up
+        self._build_dir = self._build_root / self.build_type.value
+        self._active_cflags = (*self.cflags, *_BUILD_TYPE_CFLAGS[self.build_type])
         console.print(f"[yellow bold]Build type: {self.build_type}.[/]")
         
-        res = self.compile()
-        self.link([str(r.obj_path) for r in res])
+        # One mtime map for both steps, so nothing is stat'ed twice
+        mtimes: dict[str, float] = {}
+        res = self.compile(mtimes)
+        self.link(res.obj_paths, mtimes)
         console.print("[green bold]\nBuilt executable.[/]")
         if gen_db:
-            with open("compile_commands.json", "w") as f:
-                json.dump([r.cdb_entry for r in res], f, indent=2)
+            try:
+                import orjson
+            except ImportError:
+                orjson = None
+            if orjson is not None:
+                _ = Path("compile_commands.json").write_bytes(
+                    orjson.dumps(res.cdb_entries, option=orjson.OPT_INDENT_2)
+                )
+            else:
+                # Same bytes as orjson, which writes raw UTF-8
+                with open("compile_commands.json", "w", encoding="utf-8") as f:
+                    json.dump(res.cdb_entries, f, indent=2, ensure_ascii=False)
             console.print("[yellow bold]Updated compile_commands.json.[/]")
 
     def run(self):
         _ = subprocess.run(self.app_path)
 
     def clean(self):
+        clear_system_library_cache()
+        console.print("[yellow bold]Cleared cached pkg-config results.[/]")
         if os.path.isdir(self._build_dir):
             shutil.rmtree(self._build_dir)
             console.print("[yellow bold]Cleaning build directory done.[/]")
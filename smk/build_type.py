@@ -0,0 +1,6 @@
+from enum import StrEnum, auto
+
+
+class BuildType(StrEnum):
+    Debug = auto()
+    Release = auto()
@@ -1,7 +1,10 @@
 from dataclasses import dataclass
+import json
 import os
+from pathlib import Path
 import subprocess
 import sys
+from typing import Any
 from rich.console import Console
 
 
@@ -47,27 +50,192 @@ def get_local_library(name: str, path: str, static: bool) -> Library:
 
 
 
-def get_system_library(name: str, static: bool = False) -> Library:
-    """Get cflags and libs for a system library using pkg-config"""
+# pkg-config results, in memory and on disk across runs
+_PKG_CACHE: dict[str, Library] = {}
+_pkg_disk_cache: dict[str, dict[str, Any]] | None = None
+
+
+def _pkg_cache_path() -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "smk" / "pkgconfig.json"
+
+
+def _load_pkg_cache() -> dict[str, dict[str, Any]]:
+    global _pkg_disk_cache
+    if _pkg_disk_cache is None:
+        try:
+            with open(_pkg_cache_path()) as f:
+                _pkg_disk_cache = json.load(f)
+        except (OSError, RuntimeError, json.JSONDecodeError):
+            _pkg_disk_cache = {}
+    return _pkg_disk_cache
+
+
+def _save_pkg_cache(cache: dict[str, dict[str, Any]]) -> None:
     try:
-        cf = subprocess.run(
-            ["pkg-config", "--cflags", name],
-            capture_output=True,
-            text=True,
-        ).stdout.split()
-        lds = subprocess.run(
-            [
-                "pkg-config",
-                "--libs",
-                "--static" if static else "",
-                name
-            ],
+        path = _pkg_cache_path()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(cache, f)
+    except (OSError, RuntimeError): # RuntimeError: no home directory
+        pass # the cache is only an optimization
+
+
+def _pkg_cache_key(name: str, static: bool) -> str:
+    return "|".join([
+        name,
+        "static" if static else "shared",
+        os.environ.get("PKG_CONFIG_PATH", ""),
+        os.environ.get("PKG_CONFIG_LIBDIR", ""),
+    ])
+
+
+def _pkg_config(*args: str) -> list[str]:
+    return subprocess.run(
+        ["pkg-config", *args],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.split()
+
+
+def _pkg_config_variable(variable: str, name: str) -> str | None:
+    try:
+        value = subprocess.run(
+            ["pkg-config", f"--variable={variable}", name],
             capture_output=True,
             text=True,
-        ).stdout.split()
-        console.print(f"[green]Found library (static): [bold]{name}[/][/]")
-        return Library(cflags=cf, libs=lds, name=name)
+            check=True,
+        ).stdout.strip()
+    except subprocess.CalledProcessError:
+        return None
+    return value or None
+
+
+def _pc_file(name: str) -> str | None:
+    """
+    Return path of the .pc file describing `name`, or None if unknown.
+    `--variable=pcfiledir` works with both pkg-config and pkgconf.
+    """
+    pc_dir = _pkg_config_variable("pcfiledir", name)
+    if pc_dir is None:
+        return None
+    return os.path.join(pc_dir, f"{name}.pc")
+
+
+def _pkg_search_dirs() -> list[str]:
+    """Directories pkg-config looks for .pc files in."""
+    dirs = os.environ.get("PKG_CONFIG_PATH", "").split(os.pathsep)
+    libdir = os.environ.get("PKG_CONFIG_LIBDIR")
+    if libdir is not None:
+        dirs += libdir.split(os.pathsep)
+    else:
+        dirs += (_pkg_config_variable("pc_path", "pkg-config") or "").split(os.pathsep)
+    return [d for d in dirs if d]
+
+
+def _fingerprint(paths: list[str]) -> list[list[int] | None]:
+    """
+    Inode and mtime of every path. Adding or replacing a .pc file changes
+    its directory, and a new Guix profile resolves to new inodes.
+    """
+    res: list[list[int] | None] = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            res.append(None)
+        else:
+            res.append([st.st_ino, st.st_mtime_ns])
+    return res
+
+
+def clear_system_library_cache() -> None:
+    """Forget cached pkg-config results, in memory and on disk."""
+    global _pkg_disk_cache
+    _PKG_CACHE.clear()
+    _pkg_disk_cache = {}
+    try:
+        _pkg_cache_path().unlink(missing_ok=True)
+    except (OSError, RuntimeError):
+        pass
+
+
+_LINKER_PREFIXES = ("-L", "-l", "-Wl,")
+_LINKER_FLAGS = frozenset({
+    "-rdynamic", "-static", "-shared", "-static-libgcc", "-static-libstdc++",
+})
+
+
+def _is_linker_flag(flag: str) -> bool:
+    if flag.startswith("-"):
+        return flag.startswith(_LINKER_PREFIXES) or flag in _LINKER_FLAGS
+    # Libraries given by path, e.g. /usr/lib/libfoo.a or libbar.so.1
+    filename = os.path.basename(flag)
+    return filename.endswith((".a", ".so")) or ".so." in filename
+
+
+def _split_pkg_flags(flags: list[str]) -> tuple[list[str], list[str]]:
+    """Split combined `--cflags --libs` output into cflags and libs."""
+    cf: list[str] = []
+    lds: list[str] = []
+    it = iter(flags)
+    for flag in it:
+        if flag == "-Xlinker": # takes the next argument with it
+            lds.append(flag)
+            value = next(it, None)
+            if value is not None:
+                lds.append(value)
+        elif _is_linker_flag(flag):
+            lds.append(flag)
+        elif flag == "-pthread": # needed by both compiler and linker
+            cf.append(flag)
+            lds.append(flag)
+        else:
+            cf.append(flag)
+    return cf, lds
+
+
+def get_system_library(name: str, static: bool = False) -> Library:
+    """
+    Get cflags and libs for a system library using pkg-config.
+    Results are cached until the library's .pc file or any pkg-config
+    search directory changes. Editing a required package's .pc file in
+    place goes unnoticed, `smk clean` drops the cache.
+    """
+    key = _pkg_cache_key(name, static)
+    if key in _PKG_CACHE:
+        return _PKG_CACHE[key]
+
+    disk_cache = _load_pkg_cache()
+    entry = disk_cache.get(key)
+    if entry is not None and "paths" in entry:
+        if _fingerprint(entry["paths"]) == entry["fingerprint"]:
+            console.print(f"[green]Found library (cached): [bold]{name}[/][/]")
+            lib = Library(cflags=entry["cflags"], libs=entry["libs"], name=name)
+            _PKG_CACHE[key] = lib
+            return lib
+
+    static_flag = ["--static"] if static else []
+    try:
+        cf, lds = _split_pkg_flags(_pkg_config("--cflags", "--libs", *static_flag, name))
     except subprocess.CalledProcessError as e:
         console.print(f"[red bold]Error: Could not find library '{name}' using pkg-config.[/]")
         console.print(f"[red]Stderr: {e.stderr.strip()}[/]")
         sys.exit(1)
+    console.print(f"[green]Found library (static): [bold]{name}[/][/]")
+    lib = Library(cflags=cf, libs=lds, name=name)
+    _PKG_CACHE[key] = lib
+
+    pc_path = _pc_file(name)
+    if pc_path is None:
+        return lib # can't tell when it goes stale, keep it in memory only
+    paths = [pc_path, *_pkg_search_dirs()]
+    disk_cache[key] = {
+        "cflags": cf,
+        "libs": lds,
+        "paths": paths,
+        "fingerprint": _fingerprint(paths),
+    }
+    _save_pkg_cache(disk_cache)
+    return lib